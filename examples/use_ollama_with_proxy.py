@@ -3,16 +3,53 @@
 Примеры использования Ollama Proxy с OpenAI-совместимым API
 """
 
+import atexit
 import os
+import random
 import requests
 import json
+import sys
 import time
-from typing import Iterator, Optional
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, TypeVar
+
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+try:
+    import orjson as _json
+    loads = _json.loads
+    dumps = _json.dumps
+except ImportError:
+    loads = json.loads
+
+    def dumps(obj) -> bytes:
+        return json.dumps(obj).encode()
+
+JSON_HEADERS = {"Content-Type": "application/json"}
 
 BASE_URL = os.getenv("BASE_URL", "http://localhost:18080")
 REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "60"))
 STREAM_TIMEOUT = float(os.getenv("STREAM_TIMEOUT", "90"))
 
+SSE_DATA = b"data: "
+SSE_DONE = b"[DONE]"
+
+# Одна сессия с пулом соединений на все примеры: keep-alive экономит
+# TCP handshake на каждом запросе к прокси. TCP_NODELAY для мелких
+# SSE-чанков urllib3 включает по умолчанию.
+SESSION = requests.Session()
+SESSION.headers["Connection"] = "keep-alive"
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+atexit.register(SESSION.close)
+
+# Потолок одновременных запросов к прокси: пусть пропускную способность
+# определяет латентность, а не искусственный RPS-лимит.
+MAX_CONCURRENCY = 20
+
 
 def _print_error(resp: requests.Response, prefix: str = "Error"):
     try:
@@ -23,6 +60,56 @@ def _print_error(resp: requests.Response, prefix: str = "Error"):
     if body:
         print(body)
 
+
+def _iter_sse_lines(resp: requests.Response, chunk_size: int = 65536) -> Iterator[bytes]:
+    """Читает тело SSE крупными блоками и отдаёт непустые строки как bytes"""
+    raw = resp.raw
+    raw.decode_content = True
+    buf = bytearray()
+    # raw.stream() отдаёт данные по мере прихода chunk'ов, минуя обёртку
+    # iter_content; raw.read(n) ждал бы полные n байт и тормозил стрим.
+    for chunk in raw.stream(chunk_size, decode_content=True):
+        buf += chunk
+        *lines, rest = buf.split(b"\n")
+        buf = bytearray(rest)
+        for line in lines:
+            line = line.rstrip(b"\r")
+            if line:
+                yield bytes(line)
+    if buf.strip():
+        yield bytes(buf.rstrip(b"\r"))
+
+
+def _flush_stdout(parts: List[str]):
+    """Выводит накопленные фрагменты одной записью в stdout"""
+    if not parts:
+        return
+    sys.stdout.write("".join(parts))
+    sys.stdout.flush()
+    parts.clear()
+
+
+def _retry_delay(resp: requests.Response, base: float, prev_delay: float, cap: float) -> float:
+    """Пауза перед ретраем: Retry-After, если есть, иначе decorrelated jitter"""
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after is not None:
+        try:
+            return min(cap, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return min(cap, random.uniform(base, prev_delay * 3))
+
+
+T = TypeVar("T")
+
+
+def _submit_many(payloads: List[dict], send: Callable[[dict], T],
+                 max_concurrency: int = MAX_CONCURRENCY) -> List[T]:
+    """Прогоняет пачку запросов через send в пуле из max_concurrency потоков"""
+    with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+        return list(pool.map(send, payloads))
+
+
 def example_streaming_request():
     """Пример streaming запроса с обработкой SSE"""
     print("=== Streaming Request ===\n")
@@ -37,7 +124,7 @@ def example_streaming_request():
     }
     
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{BASE_URL}/v1/chat/completions",
             json=payload,
             stream=True,
@@ -52,30 +139,44 @@ def example_streaming_request():
         return
     
     print("Response chunks:")
+    out = []
+    pending = 0
     start = time.time()
-    for line in response.iter_lines():
-        if time.time() - start > STREAM_TIMEOUT:
-            print("\n[Stream aborted due to timeout]")
-            break
-        if line:
-            line = line.decode('utf-8')
-            if line.startswith('data: '):
-                data = line[6:]
-                if data == '[DONE]':
-                    print("\n[Stream completed]")
-                    break
-                try:
-                    chunk = json.loads(data)
-                    choice = chunk['choices'][0]
-                    delta = choice.get('delta', {}) or {}
-                    content = delta.get('content') or choice.get('message', {}).get('content')
-                    if content:
-                        print(content, end='', flush=True)
-                    else:
-                        # fallback: show raw chunk for debugging empty payloads
-                        print(f"\n[chunk no content] {json.dumps(chunk, ensure_ascii=False)}")
-                except json.JSONDecodeError:
-                    pass
+    with response:
+        for line in _iter_sse_lines(response):
+            if time.time() - start > STREAM_TIMEOUT:
+                _flush_stdout(out)
+                print("\n[Stream aborted due to timeout]")
+                break
+            if line[:6] != SSE_DATA:
+                continue
+            data = line[6:]
+            if data == SSE_DONE:
+                _flush_stdout(out)
+                print("\n[Stream completed]")
+                # дочитываем хвост, чтобы соединение вернулось в пул keep-alive
+                response.raw.drain_conn()
+                break
+            try:
+                chunk = loads(data)
+                choice = chunk['choices'][0]
+                delta = choice.get('delta', {}) or {}
+                content = delta.get('content') or choice.get('message', {}).get('content')
+                if content:
+                    out.append(content)
+                    pending += len(content)
+                    # пишем в stdout пачками, а не flush на каждый токен
+                    if pending >= 256 or '\n' in content:
+                        _flush_stdout(out)
+                        pending = 0
+                else:
+                    _flush_stdout(out)
+                    pending = 0
+                    # fallback: show raw chunk for debugging empty payloads
+                    print(f"\n[chunk no content] {json.dumps(chunk, ensure_ascii=False)}")
+            except json.JSONDecodeError:
+                pass
+    _flush_stdout(out)
     print()
 
 
@@ -92,19 +193,20 @@ def example_non_streaming_request():
         "max_tokens": 100
     }
     
-    response = requests.post(
+    response = SESSION.post(
         f"{BASE_URL}/v1/chat/completions",
         json=payload,
+        stream=False,
         timeout=REQUEST_TIMEOUT
     )
 
     try:
         response.raise_for_status()
-        result = response.json()
+        result = loads(response.content)
         print("Response:")
         print(result['choices'][0]['message']['content'])
         print(f"\nFinish reason: {result['choices'][0]['finish_reason']}")
-    except requests.RequestException as e:
+    except (requests.RequestException, ValueError) as e:
         print(f"Non-streaming request failed: {e}")
         _print_error(response)
 
@@ -113,12 +215,12 @@ def example_get_models():
     """Получение списка доступных моделей"""
     print("\n=== Available Models ===\n")
     
-    response = requests.get(f"{BASE_URL}/v1/models")
+    response = SESSION.get(f"{BASE_URL}/v1/models")
     
     if response.status_code == 200:
-        models = response.json()
-        for model in models['data']:
-            print(f"- {model['id']} (owned by: {model['owned_by']})")
+        models = loads(response.content)
+        out = "\n".join(f"- {m['id']} (owned by: {m['owned_by']})" for m in models['data'])
+        sys.stdout.write(out + "\n")
     else:
         _print_error(response)
 
@@ -127,10 +229,10 @@ def example_get_stats():
     """Получение статистики загрузки системы"""
     print("\n=== System Stats ===\n")
     
-    response = requests.get(f"{BASE_URL}/v1/stats")
+    response = SESSION.get(f"{BASE_URL}/v1/stats")
     
     if response.status_code == 200:
-        stats = response.json()
+        stats = loads(response.content)
         print(f"Active workers: {stats['active']}/{stats['capacity']}")
         print(f"Queued jobs: {stats['queued']}")
         print(f"Max queue size: {stats['max_queue']}")
@@ -146,31 +248,37 @@ def example_get_stats():
         _print_error(response)
 
 
-def example_rate_limit_handling():
+def example_rate_limit_handling(batch_size=None):
     """Пример обработки rate limiting с retry"""
     print("\n=== Rate Limit Handling ===\n")
     
-    def make_request_with_retry(max_retries=3, backoff=2):
-        payload = {
-            "model": "gpt-oss:20b",
-            "messages": [{"role": "user", "content": "Hello"}],
-            "stream": False
-        }
+    if batch_size is None:
+        batch_size = int(os.getenv("RATE_LIMIT_BATCH", "1"))
+    
+    def make_request_with_retry(payload, max_retries=3, backoff=2, cap=60):
+        # Тело сериализуем один раз на все попытки.
+        # Один ключ на логический запрос, чтобы сервер мог отбросить дубли ретраев
+        body = dumps(payload)
+        headers = {**JSON_HEADERS, "Idempotency-Key": str(uuid.uuid4())}
+        delay = backoff
         
         for attempt in range(max_retries):
             try:
-                response = requests.post(
+                response = SESSION.post(
                     f"{BASE_URL}/v1/chat/completions",
-                    json=payload,
+                    data=body,
+                    headers=headers,
+                    stream=False,
                     timeout=300
                 )
                 
                 if response.status_code == 200:
-                    return response.json()
-                elif response.status_code == 429:
-                    print(f"Rate limited, retry {attempt + 1}/{max_retries}")
+                    return loads(response.content)
+                elif response.status_code in (429, 503):
+                    print(f"Retryable status {response.status_code}, retry {attempt + 1}/{max_retries}")
                     if attempt < max_retries - 1:
-                        time.sleep(backoff ** attempt)
+                        delay = _retry_delay(response, backoff, delay, cap)
+                        time.sleep(delay)
                         continue
                     else:
                         print("Max retries exceeded")
@@ -184,7 +292,25 @@ def example_rate_limit_handling():
         
         return None
     
-    result = make_request_with_retry()
+    if batch_size > 1:
+        payloads = [
+            {
+                "model": "gpt-oss:20b",
+                "messages": [{"role": "user", "content": f"Hello #{i}"}],
+                "stream": False
+            }
+            for i in range(batch_size)
+        ]
+        results = _submit_many(payloads, make_request_with_retry)
+        ok = sum(1 for r in results if r is not None)
+        print(f"Batch of {batch_size}: {ok} ok, {batch_size - ok} failed")
+        return
+
+    result = make_request_with_retry({
+        "model": "gpt-oss:20b",
+        "messages": [{"role": "user", "content": "Hello"}],
+        "stream": False
+    })
     if result:
         print("Request successful!")
         print(result['choices'][0]['message']['content'][:100] + "...")
@@ -198,28 +324,39 @@ def example_conversation():
         {"role": "user", "content": "Привет! Как тебя зовут?"}
     ]
     
+    # CONV_CACHE — задел под будущую функцию gateway: хранить историю беседы
+    # по conversation_id и принимать только новые сообщения. Текущий gateway
+    # это поле игнорирует, так что с CONV_CACHE модель теряет контекст.
+    conv_cache = bool(os.getenv("CONV_CACHE"))
+    conversation_id = str(uuid.uuid4())
+    acked = 0
+    
     for turn in range(2):
         payload = {
             "model": "gpt-oss:20b",
-            "messages": messages,
+            "messages": messages[acked:] if conv_cache else messages,
             "stream": False,
             "max_tokens": 100
         }
+        if conv_cache:
+            payload["conversation_id"] = conversation_id
         
-        response = requests.post(
+        response = SESSION.post(
             f"{BASE_URL}/v1/chat/completions",
-            json=payload,
+            data=dumps(payload),
+            headers=JSON_HEADERS,
             timeout=REQUEST_TIMEOUT
         )
         
         if response.status_code == 200:
-            result = response.json()
+            result = loads(response.content)
             assistant_message = result['choices'][0]['message']['content']
             
             print(f"User: {messages[-1]['content']}")
             print(f"Assistant: {assistant_message}\n")
             
             messages.append({"role": "assistant", "content": assistant_message})
+            acked = len(messages)
             
             if turn == 0:
                 messages.append({"role": "user", "content": "Расскажи короткую шутку"})
@@ -228,23 +365,76 @@ def example_conversation():
             break
 
 
+def _print_stats_line(stats: dict):
+    timestamp = time.strftime("%H:%M:%S")
+    print(f"[{timestamp}] Active: {stats['active']}/{stats['capacity']} | "
+          f"Queued: {stats['queued']} | "
+          f"Available: {stats['capacity'] - stats['active']}")
+
+
+def _monitor_stats_stream(end_time: float) -> bool:
+    """Подписка на SSE /v1/stats/stream до end_time.
+
+    Возвращает False, если прокси её не поддерживает или поток оборвался
+    раньше срока — тогда остаток окна покрывает опрос.
+    """
+    remaining = end_time - time.monotonic()
+    try:
+        response = SESSION.get(f"{BASE_URL}/v1/stats/stream", stream=True,
+                               timeout=(2, max(remaining, 0.1)))
+    except requests.RequestException:
+        return False
+    
+    with response:
+        content_type = response.headers.get("Content-Type", "")
+        if response.status_code != 200 or not content_type.startswith("text/event-stream"):
+            return False
+        
+        # Таймаут чтения сокета = остаток окна: тишина в потоке не ошибка
+        sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+        try:
+            for line in _iter_sse_lines(response):
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    return True
+                if sock is not None:
+                    sock.settimeout(remaining)
+                if line[:6] != SSE_DATA:
+                    continue
+                try:
+                    _print_stats_line(loads(line[6:]))
+                except ValueError:
+                    pass
+        except (requests.RequestException, Urllib3HTTPError) as e:
+            # raw.stream() поднимает исключения urllib3 без обёртки requests
+            if time.monotonic() >= end_time:
+                return True
+            print(f"Stats stream failed: {e}")
+    return time.monotonic() >= end_time
+
+
 def example_monitor_stats(duration_seconds=10):
     """Мониторинг статистики в реальном времени"""
     print(f"\n=== Monitoring Stats for {duration_seconds}s ===\n")
     
-    end_time = time.time() + duration_seconds
+    end_time = time.monotonic() + duration_seconds
+    if _monitor_stats_stream(end_time):
+        return
     
-    while time.time() < end_time:
-        response = requests.get(f"{BASE_URL}/v1/stats")
+    next_tick = time.monotonic()
+    
+    while next_tick < end_time:
+        time.sleep(max(0, next_tick - time.monotonic()))
+        next_tick += 1.0
         
-        if response.status_code == 200:
-            stats = response.json()
-            timestamp = time.strftime("%H:%M:%S")
-            print(f"[{timestamp}] Active: {stats['active']}/{stats['capacity']} | "
-                  f"Queued: {stats['queued']} | "
-                  f"Available: {stats['capacity'] - stats['active']}")
+        try:
+            response = SESSION.get(f"{BASE_URL}/v1/stats", timeout=2)
+        except requests.RequestException as e:
+            print(f"Stats request failed: {e}")
+            continue
         
-        time.sleep(1)
+        if response.status_code == 200:
+            _print_stats_line(loads(response.content))
 
 
 def example_openai_compatible():
@@ -275,6 +465,13 @@ def example_openai_compatible():
 
 
 if __name__ == "__main__":
+    # Открываем keep-alive соединение заранее, чтобы первый пример
+    # переиспользовал его из пула
+    try:
+        SESSION.get(f"{BASE_URL}/health", timeout=2)
+    except requests.RequestException:
+        pass
+
     print("Ollama Proxy API Examples\n" + "="*50)
     
     mode = os.getenv("EXAMPLES_MODE", "basic").lower()